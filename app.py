@@ -1,24 +1,36 @@
 # app.py — cleaned & production-ready
+import io
 import os
-import uuid
+import time
+import atexit
+import threading
+import tempfile
 import zipfile
 import logging
 import secrets
 import shutil
-import traceback
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
 from pathlib import Path
 
+from PIL import Image
 from flask import (
     Flask, render_template, request, jsonify,
-    send_file, flash, redirect, url_for
+    send_file, flash, redirect, url_for, Response
 )
+from markupsafe import escape
 from werkzeug.utils import secure_filename
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 # --- Your utilities ---
-from utils.map_parser import parse_html_map
-from utils.image_slicer import slice_image
-from utils.uploader import upload_to_cloudinary, get_cloudinary_status
+from utils.map_parser import parse_html_map, validate_coords_batch
+from utils.image_slicer import (
+    SLICE_FORMATS, load_image_once, slice_image_to_bytes, validate_image_file_fast
+)
+from utils.uploader import (
+    init_cloudinary, upload_to_cloudinary, upload_slice_bytes, get_cloudinary_status
+)
+from utils.uploader_async import ASYNC_UPLOAD_AVAILABLE, upload_slices
 
 # =========================
 # App bootstrap (MUST come first)
@@ -29,16 +41,32 @@ app.secret_key = os.getenv("SECRET_KEY") or secrets.token_hex(32)
 # behind proxy on Railway
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
+# let the front proxy stream downloads from disk
+#   USE_X_SENDFILE=1            → X-Sendfile (Apache / lighttpd)
+#   X_ACCEL_REDIRECT_PREFIX=... → X-Accel-Redirect to an internal Nginx location
+app.use_x_sendfile = os.getenv("USE_X_SENDFILE") == "1"
+X_ACCEL_REDIRECT_PREFIX = os.getenv("X_ACCEL_REDIRECT_PREFIX", "").strip()
+
 # logging
 logging.basicConfig(level=logging.INFO)
 app.logger.setLevel(logging.INFO)
 logging.getLogger("urllib3").setLevel(logging.INFO)
 
-# Cloudinary status (won't block startup)
+# compress HTML responses (the /process preview embeds the whole template)
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_MIN_SIZE"] = 1024
 try:
+    from flask_compress import Compress
+    Compress(app)
+except Exception as e:
+    app.logger.warning("flask-compress unavailable, responses sent uncompressed: %s", e)
+
+# Cloudinary: configure the SDK exactly once per process, then report status (won't block startup)
+try:
+    init_cloudinary()
     app.logger.warning({"cloudinary_status": get_cloudinary_status()})
 except Exception as e:
-    app.logger.error(f"uploader status failed: {e}\n{traceback.format_exc()}")
+    app.logger.exception("uploader status failed: %s", e)
 
 # health & debug routes
 @app.get("/healthz")
@@ -49,39 +77,134 @@ def healthz():
 def debug_cloudinary():
     """Create a tiny image, try upload_to_cloudinary, return the resulting URL."""
     try:
-        from PIL import Image
         tmp_path = "/tmp/diag.png"
         Image.new("RGB", (16, 16), (10, 200, 50)).save(tmp_path, "PNG")
         url = upload_to_cloudinary(tmp_path, public_id="diag_test")
         return {"ok": True, "result_url": url}
     except Exception as e:
-        app.logger.error(f"/debug/cloudinary failed: {e}\n{traceback.format_exc()}")
+        app.logger.exception("/debug/cloudinary failed: %s", e)
         return jsonify({"ok": False, "error": str(e)}), 500
 
 # =========================
 # Configuration
 # =========================
 UPLOAD_FOLDER = "uploads"
-SLICES_FOLDER = "slices"
 OUTPUT_FOLDER = "output"
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
+SLICE_MAX_WORKERS = 4
+# encoding of the slices uploaded to Cloudinary: PNG | WEBP | JPEG.
+# The CDN URL keeps this format, and WebP is not shown by every email client.
+SLICE_FORMAT = os.getenv("SLICE_FORMAT", "PNG").strip().upper()
+if SLICE_FORMAT not in SLICE_FORMATS:
+    app.logger.warning("SLICE_FORMAT=%r not in %s, using PNG", SLICE_FORMAT, sorted(SLICE_FORMATS))
+    SLICE_FORMAT = "PNG"
+UPLOAD_MAX_WORKERS = 16
+# opt-in: upload slices over one shared httpx (HTTP/2) client instead of the SDK thread pool
+ASYNC_UPLOAD = os.getenv("CLOUDINARY_ASYNC_UPLOAD") == "1" and ASYNC_UPLOAD_AVAILABLE
+UPLOAD_COPY_BUFFER = 1 << 20  # Werkzeug's file.save copies in 16 KiB chunks
+ZIP_COMPRESS_LEVEL = 1       # HTML compresses nearly as well at level 1, at a fraction of the CPU
 
-for folder in (UPLOAD_FOLDER, SLICES_FOLDER, OUTPUT_FOLDER):
+for folder in (UPLOAD_FOLDER, OUTPUT_FOLDER):
     os.makedirs(folder, exist_ok=True)
 
 def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def cleanup_session_files(session_id: str) -> None:
-    """Clean up temporary files for a session."""
+# only maps up to this many characters are memoized, so the cache can't pin large submissions
+PARSE_CACHE_MAX_CHARS = 64 * 1024
+
+def _parse_map(map_html: str) -> list[dict]:
+    """parse_html_map, memoized for typical-size maps (retries often resend the same map).
+    Returned area dicts may be shared between requests — treat them as read-only."""
+    if len(map_html) > PARSE_CACHE_MAX_CHARS:
+        return parse_html_map(map_html)
+    return list(_cached_parse(map_html))
+
+@lru_cache(maxsize=256)
+def _cached_parse(map_html: str) -> tuple[dict, ...]:
+    return tuple(parse_html_map(map_html))
+
+class SliceError(Exception):
+    """A per-slice job failed; carries the slice index and the original exception."""
+    def __init__(self, index: int, cause: BaseException):
+        super().__init__(f"slice {index} failed: {cause}")
+        self.index = index
+        self.cause = cause
+
+def _map_in_order(fn, jobs: list[tuple], max_workers: int) -> list:
+    """
+    Run fn(*job) for every job in a thread pool and return results in job order.
+    On the first failure pending jobs are cancelled and SliceError is raised
+    once the pool has drained (so callers can safely clean up afterwards).
+    """
+    failed = None
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as ex:
+        futures = [ex.submit(fn, *job) for job in jobs]
+        wait(futures, return_when=FIRST_EXCEPTION)
+        for i, fut in enumerate(futures):
+            if fut.done() and not fut.cancelled() and fut.exception() is not None:
+                failed = SliceError(i, fut.exception())
+                for other in futures:
+                    other.cancel()
+                break
+    if failed is not None:
+        raise failed
+    return [fut.result() for fut in futures]
+
+def _upload_slices(slice_blobs: list[bytes]) -> list[str]:
+    """Upload encoded slices, returning URLs in order; raises SliceError on the first failure."""
+    if ASYNC_UPLOAD:
+        results = upload_slices(slice_blobs)
+        for i, result in enumerate(results):
+            if isinstance(result, BaseException):
+                raise SliceError(i, result)
+        return results
+    return _map_in_order(
+        upload_slice_bytes,
+        [(blob,) for blob in slice_blobs],
+        max_workers=min(UPLOAD_MAX_WORKERS, len(slice_blobs)),
+    )
+
+# recently built ZIPs, keyed by filename → (expires_at, bytes)
+ZIP_CACHE_MAX = 256
+ZIP_CACHE_TTL = 3600
+_ZIP_CACHE: dict[str, tuple[float, bytes]] = {}
+_ZIP_CACHE_LOCK = threading.Lock()
+
+def _zip_cache_put(name: str, data: bytes) -> None:
+    now = time.monotonic()
+    with _ZIP_CACHE_LOCK:
+        for key in [k for k, (exp, _) in _ZIP_CACHE.items() if exp <= now]:
+            del _ZIP_CACHE[key]
+        while len(_ZIP_CACHE) >= ZIP_CACHE_MAX:
+            del _ZIP_CACHE[next(iter(_ZIP_CACHE))]  # oldest insert first
+        _ZIP_CACHE[name] = (now + ZIP_CACHE_TTL, data)
+
+def _zip_cache_pop(name: str) -> bytes | None:
+    with _ZIP_CACHE_LOCK:
+        entry = _ZIP_CACHE.pop(name, None)
+    if entry is None or entry[0] <= time.monotonic():
+        return None
+    return entry[1]
+
+# temp-dir removal never sits on the request path
+_CLEANUP_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cleanup")
+atexit.register(_CLEANUP_POOL.shutdown, wait=False)
+
+def _do_cleanup(session_id: str) -> None:
     try:
-        for base in (UPLOAD_FOLDER, SLICES_FOLDER):
-            session_dir = os.path.join(base, session_id)
-            if os.path.exists(session_dir):
-                shutil.rmtree(session_dir, ignore_errors=True)
+        shutil.rmtree(os.path.join(UPLOAD_FOLDER, session_id), ignore_errors=True)
     except Exception as e:
         app.logger.error(f"cleanup error: {e}")
 
+def cleanup_session_files(session_id: str) -> None:
+    """Clean up temporary files for a session (in a background thread)."""
+    try:
+        _CLEANUP_POOL.submit(_do_cleanup, session_id)
+    except RuntimeError:
+        # pool already shut down (interpreter exiting) → clean up inline
+        _do_cleanup(session_id)
+
 # =========================
 # Views
 # =========================
@@ -97,7 +220,7 @@ def process_image():
     3) 上傳每塊到 Cloudinary（或 fallback）
     4) 產生 email HTML + ZIP，提供預覽與下載連結
     """
-    session_id = str(uuid.uuid4())
+    session_id = None
     try:
         if "image" not in request.files:
             flash("未提供圖片檔案", "error")
@@ -109,63 +232,89 @@ def process_image():
         if not file or file.filename == "":
             flash("未選擇圖片檔案", "error")
             return redirect(url_for("index"))
+        if not allowed_file(file.filename):
+            flash("檔案格式不正確，請上傳 PNG、JPG、JPEG 或 GIF 檔案。", "error")
+            return redirect(url_for("index"))
         if not map_html:
             flash("未提供 HTML 地圖代碼", "error")
             return redirect(url_for("index"))
-        if not allowed_file(file.filename):
+
+        # parse map first — nothing touches the disk until there is real work
+        areas = _parse_map(map_html)
+        if not areas:
+            flash("在 HTML 地圖中找不到有效的區域標籤", "error")
+            return redirect(url_for("index"))
+
+        # sniff the magic bytes from the upload stream — non-images are rejected before disk I/O
+        head = file.stream.read(16)
+        file.stream.seek(0)
+        if not validate_image_file_fast(head):
             flash("檔案格式不正確，請上傳 PNG、JPG、JPEG 或 GIF 檔案。", "error")
             return redirect(url_for("index"))
 
         # session dirs
-        session_upload_dir = os.path.join(UPLOAD_FOLDER, session_id)
-        session_slices_dir = os.path.join(SLICES_FOLDER, session_id)
-        os.makedirs(session_upload_dir, exist_ok=True)
-        os.makedirs(session_slices_dir, exist_ok=True)
+        # mkdtemp gives an atomic, race-free name; it doubles as the session id
+        session_upload_dir = tempfile.mkdtemp(prefix="s", dir=UPLOAD_FOLDER)
+        session_id = os.path.basename(session_upload_dir)
 
         # save upload
         filename = secure_filename(file.filename or "uploaded_image")
         file_path = os.path.join(session_upload_dir, filename)
-        file.save(file_path)
+        with open(file_path, "wb", buffering=UPLOAD_COPY_BUFFER) as out:
+            shutil.copyfileobj(file.stream, out, length=UPLOAD_COPY_BUFFER)
 
-        # parse map
-        areas = parse_html_map(map_html)
-        if not areas:
+        # slice & upload
+        # phase 1: crop slices (PIL releases the GIL while decoding/encoding)
+        # phase 2: upload all slices concurrently (network bound)
+        try:
+            # decode the source once; every slice is cropped from the same pixels
+            # and kept in memory — no slice ever touches the disk
+            with load_image_once(file_path) as (src, (width, height)):
+                # reject out-of-bounds areas up front, before any slicing work
+                valid = validate_coords_batch([area["coords"] for area in areas], width, height)
+                if not valid.all():
+                    i = int(valid.argmin())
+                    raise SliceError(i, ValueError(
+                        f"Coordinates {areas[i]['coords']} are invalid for image size ({width}x{height})"
+                    ))
+                slice_blobs = _map_in_order(
+                    slice_image_to_bytes,
+                    [(src, area["coords"], SLICE_FORMAT) for area in areas],
+                    max_workers=min(SLICE_MAX_WORKERS, len(areas)),
+                )
+            # content-hash public_ids: identical slices are uploaded only once
+            urls = _upload_slices(slice_blobs)
+        except SliceError as e:
+            app.logger.error("slice %d failed: %s", e.index, e.cause)
             cleanup_session_files(session_id)
-            flash("在 HTML 地圖中找不到有效的區域標籤", "error")
+            flash(f"處理圖片切片 {e.index+1} 時發生錯誤：{str(e.cause)}", "error")
             return redirect(url_for("index"))
 
-        # slice & upload
-        sliced_images = []
-        for i, area in enumerate(areas):
-            try:
-                slice_path = slice_image(file_path, area["coords"], i, session_slices_dir)
-                public_id = f"{session_id}_slice_{i}"
-                cloud_url = upload_to_cloudinary(slice_path, public_id)
-                sliced_images.append({
-                    "url": cloud_url,
-                    "href": area.get("href"),
-                    "alt": area.get("alt", f"圖片切片 {i+1}"),
-                    "title": area.get("title", "")
-                })
-            except Exception as e:
-                app.logger.error(f"slice {i} failed: {e}")
-                cleanup_session_files(session_id)
-                flash(f"處理圖片切片 {i+1} 時發生錯誤：{str(e)}", "error")
-                return redirect(url_for("index"))
+        sliced_images = [
+            {
+                "url": cloud_url,
+                "href": area.get("href"),
+                "alt": area.get("alt", f"圖片切片 {i+1}"),
+                "title": area.get("title", ""),
+            }
+            for i, (area, cloud_url) in enumerate(zip(areas, urls))
+        ]
 
         # build HTML
         html_content = generate_responsive_html(sliced_images)
 
-        # save HTML & ZIP
-        html_filename = f"email_template_{session_id}.html"
-        html_path = os.path.join(OUTPUT_FOLDER, html_filename)
-        with open(html_path, "w", encoding="utf-8") as f:
-            f.write(html_content)
-
+        # save ZIP (HTML is written straight into the archive)
         zip_filename = f"email_template_{session_id}.zip"
         zip_path = os.path.join(OUTPUT_FOLDER, zip_filename)
-        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as z:
-            z.write(html_path, arcname="email_template.html")
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESS_LEVEL) as z:
+            z.writestr("email_template.html", html_content)
+        zip_bytes = buf.getvalue()
+        # keep it in memory for the download that usually follows right away;
+        # the disk copy serves other workers and requests after the TTL
+        _zip_cache_put(zip_filename, zip_bytes)
+        with open(zip_path, "wb") as f:
+            f.write(zip_bytes)
 
         # cleanup temp
         cleanup_session_files(session_id)
@@ -178,9 +327,10 @@ def process_image():
             sliced_count=len(sliced_images),
         )
     except Exception as e:
-        app.logger.error(f"process_image error: {e}\n{traceback.format_exc()}")
+        app.logger.exception("process_image error: %s", e)
         try:
-            cleanup_session_files(session_id)
+            if session_id:
+                cleanup_session_files(session_id)
         except Exception:
             pass
         flash(f"發生錯誤：{str(e)}", "error")
@@ -194,10 +344,26 @@ def download_zip(filename):
     """
     try:
         safe = secure_filename(filename)
+        zip_bytes = _zip_cache_pop(safe)
+        if zip_bytes is not None:
+            return send_file(
+                io.BytesIO(zip_bytes),
+                mimetype="application/zip",
+                as_attachment=True,
+                download_name=safe,
+                max_age=0,
+            )
         file_path = Path(OUTPUT_FOLDER) / safe
         if not file_path.exists():
             # 如果更想回首頁提示，可換成 flash + redirect
             return jsonify({"ok": False, "error": "file not found"}), 404
+        if X_ACCEL_REDIRECT_PREFIX:
+            # 交給前端 Nginx 直接由磁碟送檔
+            resp = Response(mimetype="application/zip")
+            resp.headers["X-Accel-Redirect"] = f"{X_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{safe}"
+            resp.headers["Content-Disposition"] = f'attachment; filename="{safe}"'
+            resp.cache_control.no_cache = True
+            return resp
         return send_file(
             file_path,
             mimetype="application/zip",
@@ -206,14 +372,12 @@ def download_zip(filename):
             max_age=0,
         )
     except Exception as e:
-        app.logger.error(f"download_zip error: {e}\n{traceback.format_exc()}")
+        app.logger.exception("download_zip error: %s", e)
         return jsonify({"ok": False, "error": str(e)}), 500
 
 # ============== helpers ==============
-def generate_responsive_html(sliced_images: list[dict]) -> str:
-    """Generate fully responsive HTML with sliced images for all devices."""
-    html_parts = []
-    html_parts.append("""<!DOCTYPE html>
+# static email shell, built once at import
+_HTML_HEAD = """<!DOCTYPE html>
 <html lang="zh-TW">
 <head>
 <meta charset="UTF-8">
@@ -240,21 +404,35 @@ body {
 </style>
 </head>
 <body>
-  <div class="email-container">""")
-    for i, image in enumerate(sliced_images):
-        loading_attr = 'loading="lazy"' if i > 0 else ""
-        html_parts.append(f"""
-    <a href="{image.get('href')}" class="image-section" target="_blank" rel="noopener noreferrer">
-      <img src="{image.get('url')}"
-           alt="{image.get('alt', f'圖片切片 {i+1}')}"
-           title="{image.get('title','')}"
-           {loading_attr}
-           style="width:100%;height:auto;display:block;border:0;">
-    </a>""")
-    html_parts.append("""
+  <div class="email-container">"""
+
+_HTML_TAIL = """
   </div>
 </body>
-</html>""")
+</html>"""
+
+# one <a><img></a> block per slice; values are HTML-escaped before filling
+_IMG_TPL = """
+    <a href="{href}" class="image-section" target="_blank" rel="noopener noreferrer">
+      <img src="{url}"
+           alt="{alt}"
+           title="{title}"
+           {loading}
+           style="width:100%;height:auto;display:block;border:0;">
+    </a>"""
+
+def generate_responsive_html(sliced_images: list[dict]) -> str:
+    """Generate fully responsive HTML with sliced images for all devices."""
+    html_parts = [_HTML_HEAD]
+    for i, image in enumerate(sliced_images):
+        html_parts.append(_IMG_TPL.format_map({
+            "href": escape(image.get("href")),
+            "url": escape(image.get("url")),
+            "alt": escape(image.get("alt", f"圖片切片 {i+1}")),
+            "title": escape(image.get("title", "")),
+            "loading": 'loading="lazy"' if i > 0 else "",
+        }))
+    html_parts.append(_HTML_TAIL)
     return "\n".join(html_parts)
 
 # ------ error handlers ------
@@ -265,6 +443,6 @@ def too_large(e):
 
 @app.errorhandler(500)
 def internal_error(e):
-    app.logger.error(f"500: {e}\n{traceback.format_exc()}")
+    app.logger.exception("500: %s", e)
     flash("An internal error occurred. Please try again.", "error")
     return redirect(url_for("index"))
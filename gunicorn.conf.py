@@ -2,8 +2,12 @@
 import os
 
 bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
-workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
-threads = int(os.environ.get("WEB_THREADS", "4"))
+# /process mostly waits on Cloudinary I/O, so overshoot workers and use threads
+workers = int(os.environ.get("WEB_CONCURRENCY", str(max(2, (os.cpu_count() or 2) * 2 + 1))))
+threads = int(os.environ.get("WEB_THREADS", "8"))
+worker_class = os.environ.get("WORKER_CLASS", "gthread")
+# keep worker heartbeat files off disk when tmpfs is available
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
 timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
 graceful_timeout = 30
 keepalive = 30
@@ -0,0 +1,26 @@
+import time
+import unittest
+
+from utils.map_parser import parse_html_map
+
+
+class ParseHtmlMapTest(unittest.TestCase):
+    def test_plain_area_list(self):
+        areas = parse_html_map(
+            '<area shape="rect" coords="0,0,10,20" href="https://a" alt="A&amp;B">\n'
+            '<area coords="10,0,20,20" href="https://b" />'
+        )
+        self.assertEqual([a['coords'] for a in areas], [(0, 0, 10, 20), (10, 0, 20, 20)])
+        self.assertEqual(areas[0]['alt'], 'A&B')
+        self.assertEqual(areas[1]['href'], 'https://b')
+
+    def test_long_bare_attribute_is_linear(self):
+        # used to backtrack quadratically in the regex fast path (seconds at 20k chars)
+        for n in (40_000, 200_000):
+            start = time.perf_counter()
+            self.assertEqual(parse_html_map('<area ' + 'a' * n + '>'), [])
+            self.assertLess(time.perf_counter() - start, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,53 +1,169 @@
 from PIL import Image
+import io
 import os
 import logging
+from contextlib import contextmanager
 
-def slice_image(image_path, coords, slice_index, output_dir):
+def _png_compress_level(raw):
+    """Parse SLICE_PNG_COMPRESS_LEVEL; anything but an integer in -1..9 falls back to 1"""
+    try:
+        level = int(raw)
+    except ValueError:
+        level = None
+    if level is None or not -1 <= level <= 9:
+        # named logger: logging.warning() here would configure the root logger before the app does
+        logging.getLogger(__name__).warning(
+            "SLICE_PNG_COMPRESS_LEVEL=%r is not an integer in -1..9, using 1", raw
+        )
+        return 1
+    return level
+
+# zlib level for slice PNGs; slices are intermediates re-encoded by the CDN,
+# so the fastest level is the default
+SLICE_PNG_COMPRESS_LEVEL = _png_compress_level(os.getenv("SLICE_PNG_COMPRESS_LEVEL", "1"))
+
+# supported slice formats → file extension
+SLICE_FORMATS = {'PNG': '.png', 'WEBP': '.webp', 'JPEG': '.jpg'}
+
+def slice_image(image_path, coords, slice_index, output_dir, fmt='PNG'):
     """
     Slice an image based on coordinates
     
     Args:
         image_path (str): Path to the source image
-        coords (list): [x1, y1, x2, y2] coordinates for slicing
+        coords (tuple | list): (x1, y1, x2, y2) coordinates for slicing
         slice_index (int): Index for naming the output file
         output_dir (str): Directory to save sliced images
+        fmt (str): Output format, one of SLICE_FORMATS (default PNG)
         
     Returns:
         str: Path to the sliced image file
     """
     try:
         # Open the image
-        with Image.open(image_path) as img:
-            # Get image dimensions
-            img_width, img_height = img.size
-            
-            # Extract coordinates
-            x1, y1, x2, y2 = coords
-            
-            # Validate coordinates
-            if x1 < 0 or y1 < 0 or x2 > img_width or y2 > img_height:
-                raise ValueError(f"Coordinates {coords} are outside image bounds ({img_width}x{img_height})")
-            
-            if x1 >= x2 or y1 >= y2:
-                raise ValueError(f"Invalid coordinates: x1={x1}, y1={y1}, x2={x2}, y2={y2}")
-            
-            # Crop the image
-            cropped_img = img.crop((x1, y1, x2, y2))
-            
-            # Generate output filename
-            output_filename = f"slice_{slice_index}.png"
-            output_path = os.path.join(output_dir, output_filename)
-            
-            # Save the cropped image as PNG to maintain quality
-            cropped_img.save(output_path, 'PNG', optimize=True)
-            
-            logging.info(f"Successfully sliced image: {output_path}")
-            return output_path
-            
+        img = Image.open(image_path)
+    except Exception as e:
+        logging.error(f"Error slicing image: {e}")
+        raise Exception(f"Failed to slice image: {str(e)}")
+    
+    with img:
+        return slice_image_from(img, coords, slice_index, output_dir, fmt)
+
+def slice_image_from(img, coords, slice_index, output_dir, fmt='PNG'):
+    """
+    Slice an already opened image based on coordinates
+    
+    Lets callers decode the source once and cut every slice from it.
+    
+    Args:
+        img (PIL.Image.Image): Opened (ideally already loaded) source image
+        coords (tuple | list): (x1, y1, x2, y2) coordinates for slicing
+        slice_index (int): Index for naming the output file
+        output_dir (str): Directory to save sliced images
+        fmt (str): Output format, one of SLICE_FORMATS (default PNG)
+        
+    Returns:
+        str: Path to the sliced image file
+    """
+    data = slice_image_to_bytes(img, coords, fmt)
+    
+    # Generate output filename
+    output_filename = f"slice_{slice_index}{SLICE_FORMATS[fmt.upper()]}"
+    output_path = os.path.join(output_dir, output_filename)
+    
+    try:
+        with open(output_path, 'wb') as f:
+            f.write(data)
+    except Exception as e:
+        logging.error(f"Error slicing image: {e}")
+        raise Exception(f"Failed to slice image: {str(e)}")
+    
+    logging.info(f"Successfully sliced image: {output_path}")
+    return output_path
+
+def slice_image_to_bytes(img, coords, fmt='PNG'):
+    """
+    Slice an already opened image and return the encoded slice in memory
+    
+    Args:
+        img (PIL.Image.Image): Opened (ideally already loaded) source image
+        coords (tuple | list): (x1, y1, x2, y2) coordinates for slicing
+        fmt (str): Output format, one of SLICE_FORMATS (default PNG)
+        
+    Returns:
+        bytes: Encoded data of the slice
+    """
+    try:
+        # Extract and validate coordinates
+        x1, y1, x2, y2 = _check_coords(coords, *img.size)
+        
+        # Crop the image
+        cropped_img = img.crop((x1, y1, x2, y2))
+        
+        buf = io.BytesIO()
+        _save_slice(cropped_img, buf, fmt)
+        return buf.getvalue()
+        
     except Exception as e:
         logging.error(f"Error slicing image: {e}")
         raise Exception(f"Failed to slice image: {str(e)}")
 
+def _save_slice(img, fp, fmt):
+    """Encode one slice; cheap settings since slices are re-encoded by the CDN"""
+    fmt = fmt.upper()
+    if fmt == 'PNG':
+        # lossless (see SLICE_PNG_COMPRESS_LEVEL)
+        img.save(fp, 'PNG', optimize=False, compress_level=SLICE_PNG_COMPRESS_LEVEL)
+    elif fmt == 'WEBP':
+        img.save(fp, 'WEBP', quality=90, method=4)
+    elif fmt == 'JPEG':
+        # JPEG has no alpha / palette
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(fp, 'JPEG', quality=90)
+    else:
+        raise ValueError(f"Unsupported slice format: {fmt}")
+
+def _check_coords(coords, img_width, img_height):
+    """Return coords as x1, y1, x2, y2 or raise ValueError if they don't fit the image"""
+    x1, y1, x2, y2 = coords
+    
+    if x1 < 0 or y1 < 0 or x2 > img_width or y2 > img_height:
+        raise ValueError(f"Coordinates {coords} are outside image bounds ({img_width}x{img_height})")
+    
+    if x1 >= x2 or y1 >= y2:
+        raise ValueError(f"Invalid coordinates: x1={x1}, y1={y1}, x2={x2}, y2={y2}")
+    
+    return x1, y1, x2, y2
+
+@contextmanager
+def load_image_once(image_path):
+    """
+    Open, decode and size an image in one step for use across a request
+    
+    Replaces the validate_image_file + get_image_dimensions + slice_image
+    sequence, which opened the same file three times. Decoding the pixels
+    up front also serves as validation: a corrupt file fails here.
+    
+    Args:
+        image_path (str): Path to the image file
+        
+    Yields:
+        tuple: (PIL.Image.Image, (width, height)); the image is closed on exit
+    """
+    img = None
+    try:
+        img = Image.open(image_path)
+        img.load()
+    except Exception as e:
+        if img is not None:
+            img.close()
+        logging.error(f"Invalid image file: {e}")
+        raise Exception(f"Failed to load image: {str(e)}")
+    
+    with img:
+        yield img, img.size
+
 def get_image_dimensions(image_path):
     """
     Get dimensions of an image
@@ -82,3 +198,34 @@ def validate_image_file(image_path):
     except Exception as e:
         logging.error(f"Invalid image file: {e}")
         return False
+
+def validate_image_file_fast(image):
+    """
+    Check that the file looks like a supported image by its magic bytes only
+    
+    Reads the first 16 bytes instead of parsing the whole file like
+    validate_image_file; use it on hot paths where format validity is enough.
+    
+    Args:
+        image (str | bytes): Path to the image file, or its leading bytes
+            (at least 16, e.g. sniffed from an upload stream before saving)
+        
+    Returns:
+        bool: True if the header is PNG, JPEG, GIF or WebP
+    """
+    if isinstance(image, (bytes, bytearray)):
+        head = bytes(image[:16])
+    else:
+        try:
+            with open(image, 'rb') as f:
+                head = f.read(16)
+        except Exception as e:
+            logging.error(f"Invalid image file: {e}")
+            return False
+    
+    return (
+        head.startswith(b'\x89PNG\r\n\x1a\n')
+        or head.startswith(b'\xff\xd8\xff')
+        or head[:6] in (b'GIF87a', b'GIF89a')
+        or (head[:4] == b'RIFF' and head[8:12] == b'WEBP')
+    )
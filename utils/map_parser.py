@@ -1,6 +1,61 @@
 import re
-from bs4 import BeautifulSoup
+import html
+from lxml import etree
+import numpy as np
 import logging
+import threading
+
+# exactly four integers "x1,y1,x2,y2"; negatives still parse so bounds
+# checking can report them
+_COORDS_RE = re.compile(r'^\s*(-?\d+)\s*,\s*(-?\d+)\s*,\s*(-?\d+)\s*,\s*(-?\d+)\s*$')
+
+# fast path for input that is nothing but <area ...> tags
+_AREA_RE = re.compile(r'<area\b([^<>]*?)/?>', re.I)
+_ATTR_RE = re.compile(r'([\w-]+)\s*=\s*"([^"]*)"')
+# the whole attribute run of one tag, anchored: a single linear pass
+_ATTRS_RUN_RE = re.compile(r'(?:\s+[\w-]+\s*=\s*"[^"]*")*\s*')
+# longer input goes straight to lxml
+_FAST_PATH_MAX_CHARS = 64 * 1024
+
+# lxml parser objects must not be shared between threads; keep one per thread
+_local = threading.local()
+
+def _html_parser():
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        parser = _local.parser = etree.HTMLParser(encoding='utf-8')
+    return parser
+
+def _fast_area_attrs(html_content):
+    """
+    Attribute dicts for input made only of <area> tags with double-quoted
+    attributes (the usual pasted map data); None for anything else, so the
+    caller falls back to the full HTML parser.
+    """
+    if len(html_content) > _FAST_PATH_MAX_CHARS or '<map' in html_content.lower():
+        return None
+    
+    areas = []
+    pos = 0
+    for m in _AREA_RE.finditer(html_content):
+        # only whitespace may sit between tags
+        if html_content[pos:m.start()].strip():
+            return None
+        pos = m.end()
+        
+        attrs_src = m.group(1)
+        if not _ATTRS_RUN_RE.fullmatch(attrs_src):
+            return None  # unquoted / single-quoted / bare attributes
+        
+        attrs = {}
+        for name, value in _ATTR_RE.findall(attrs_src):
+            # same semantics as the HTML parser: lowercase names, first one wins
+            attrs.setdefault(name.lower(), html.unescape(value))
+        areas.append(attrs)
+    
+    if html_content[pos:].strip():
+        return None
+    return areas
 
 def parse_html_map(html_content):
     """
@@ -16,15 +71,19 @@ def parse_html_map(html_content):
         # Clean up the HTML content
         html_content = html_content.strip()
         
-        # If it's just area tags without map wrapper, wrap it
-        if not html_content.startswith('<map'):
-            html_content = f'<map name="temp">{html_content}</map>'
-        
-        # Parse with BeautifulSoup
-        soup = BeautifulSoup(html_content, 'html.parser')
+        # Fast path: nothing but plain <area ...> tags → regex, no HTML parser
+        areas = _fast_area_attrs(html_content)
         
-        # Find all area tags
-        areas = soup.find_all('area')
+        if areas is None:
+            # If it's just area tags without map wrapper, wrap it
+            if not html_content.startswith('<map'):
+                html_content = f'<map name="temp">{html_content}</map>'
+            
+            # Parse straight into lxml's C tree (no BeautifulSoup wrappers)
+            root = etree.fromstring(html_content.encode('utf-8'), _html_parser())
+            
+            # Find all area tags
+            areas = root.iter('area') if root is not None else ()
         
         parsed_areas = []
         
@@ -36,12 +95,12 @@ def parse_html_map(html_content):
                     logging.warning("Area tag missing coords attribute")
                     continue
                 
-                # Parse coordinates (assuming rect format: x1,y1,x2,y2)
-                coords = [int(x.strip()) for x in coords_str.split(',')]
-                
-                if len(coords) != 4:
+                # Parse coordinates (rect format: x1,y1,x2,y2) in one regex pass
+                m = _COORDS_RE.match(coords_str)
+                if not m:
                     logging.warning(f"Invalid coordinates format: {coords_str}")
                     continue
+                coords = tuple(map(int, m.groups()))
                 
                 # Extract other attributes
                 href = str(area.get('href', '#'))
@@ -55,7 +114,7 @@ def parse_html_map(html_content):
                     continue
                 
                 parsed_areas.append({
-                    'coords': coords,  # [x1, y1, x2, y2]
+                    'coords': coords,  # (x1, y1, x2, y2), read-only
                     'href': href,
                     'alt': alt,
                     'title': title,
@@ -81,7 +140,7 @@ def validate_coordinates(coords, image_width, image_height):
     Validate that coordinates are within image bounds
     
     Args:
-        coords (list): [x1, y1, x2, y2]
+        coords (tuple | list): (x1, y1, x2, y2)
         image_width (int): Image width
         image_height (int): Image height
         
@@ -101,3 +160,33 @@ def validate_coordinates(coords, image_width, image_height):
         
     except Exception:
         return False
+
+def validate_coords_batch(coords_array, image_width, image_height):
+    """
+    Validate many [x1, y1, x2, y2] rows against the image bounds at once
+    
+    Same rule as validate_coordinates, evaluated as one vectorized NumPy
+    expression instead of a Python call per area.
+    
+    Args:
+        coords_array (array-like): (N, 4) coordinates, e.g. [a['coords'] for a in parsed_areas]
+        image_width (int): Image width
+        image_height (int): Image height
+        
+    Returns:
+        numpy.ndarray: (N,) bool mask, True where the coordinates are valid
+    """
+    try:
+        arr = np.asarray(coords_array, dtype=np.int64).reshape(-1, 4)
+    except OverflowError:
+        # a value beyond int64 can't fit any image: clamp it so its row fails the bounds check
+        info = np.iinfo(np.int64)
+        arr = np.asarray(
+            [[min(max(v, info.min), info.max) for v in row] for row in coords_array],
+            dtype=np.int64,
+        ).reshape(-1, 4)
+    return (
+        (arr[:, :2] >= 0).all(axis=1)
+        & (arr[:, 2] <= image_width) & (arr[:, 3] <= image_height)
+        & (arr[:, 0] < arr[:, 2]) & (arr[:, 1] < arr[:, 3])
+    )
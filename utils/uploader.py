@@ -1,15 +1,29 @@
 # utils/uploader.py
+import io
 import os
-import uuid
+import hashlib
 import logging
 import shutil
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Optional, Union
 
 # ========= 環境控制 =========
 FORCE_DEST = os.getenv("UPLOAD_DEST", "").strip().lower()  # "cloudinary" | "local" | ""
 LOCAL_STATIC_DIR = Path(os.getenv("LOCAL_STATIC_DIR", "static/images"))
 LOCAL_STATIC_DIR.mkdir(parents=True, exist_ok=True)
+_CREATED_DIRS = {LOCAL_STATIC_DIR}
+# 同一程序內同時進行中的 Cloudinary 上傳數上限（跨所有請求），連線池大小也依此設定；
+# SDK 與 httpx 兩條上傳路徑共用 CLOUDINARY_SLOTS
+CLOUDINARY_MAX_INFLIGHT = int(os.getenv("CLOUDINARY_MAX_INFLIGHT", "16"))
+CLOUDINARY_SLOTS = threading.BoundedSemaphore(CLOUDINARY_MAX_INFLIGHT)
+
+# 切片內容雜湊 → 雲端 URL（程序內 LRU）
+_SLICE_URL_CACHE_MAX = 1024
+_SLICE_URL_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_SLICE_URL_LOCK = threading.Lock()
 
 # 是否具備 Cloudinary 憑證
 _HAS_URL = bool(os.getenv("CLOUDINARY_URL"))
@@ -28,8 +42,16 @@ except Exception as e:
     _CLOUDINARY_IMPORTED = False
     logging.warning(f"Cloudinary import failed: {e}")
 
-def _cloudinary_config():
-    """初始化 Cloudinary 設定（支援 CLOUDINARY_URL 或三件式憑證）"""
+def init_cloudinary() -> bool:
+    """啟動時呼叫一次：套用 Cloudinary 設定並回傳是否可用"""
+    return _cloudinary_config()
+
+@lru_cache(maxsize=1)
+def _cloudinary_config() -> bool:
+    """
+    初始化 Cloudinary 設定（支援 CLOUDINARY_URL 或三件式憑證）。
+    環境變數在程序內不會變，結果快取，設定只套用一次。
+    """
     if not (_CLOUDINARY_IMPORTED and _CLOUDINARY_ENABLED):
         return False
     try:
@@ -43,11 +65,29 @@ def _cloudinary_config():
                 api_secret=os.getenv("CLOUDINARY_API_SECRET"),
                 secure=True,
             )
+        _install_http_pool()
         return True
     except Exception as e:
         logging.error(f"Cloudinary config error: {e}")
         return False
 
+def _install_http_pool():
+    """
+    SDK 預設的 urllib3 連線池每個 host 只保留 1 條 keep-alive 連線，
+    並行上傳時多出來的連線用完即丟、下次又要重新 TLS 握手。
+    換成容量等於並行上限的連線池，讓每條連線都能重複使用。
+    """
+    try:
+        from urllib3 import PoolManager
+        if not isinstance(cu._http, PoolManager):  # e.g. AppEngineManager
+            return
+        cu._http = cloudinary.utils.get_http_connector(
+            cloudinary.config(),
+            dict(cloudinary.CERT_KWARGS, maxsize=CLOUDINARY_MAX_INFLIGHT),
+        )
+    except Exception as e:
+        logging.warning(f"Cloudinary connection pool not resized: {e}")
+
 # ========= 對外主入口 =========
 def upload_image(image_path: str, public_id: Optional[str] = None, public_id_prefix: str = "slice") -> str:
     """
@@ -55,7 +95,7 @@ def upload_image(image_path: str, public_id: Optional[str] = None, public_id_pre
     參數：
       - image_path: 本機暫存檔路徑（建議放 /tmp）
       - public_id: 指定雲端 public_id（不含副檔名）
-      - public_id_prefix: 未指定 public_id 時，用 prefix + uuid 組成
+      - public_id_prefix: 未指定 public_id 時，用 prefix + 32 碼隨機 hex 組成
     回傳：可公開存取的 URL
       - Cloudinary：secure_url
       - 本機："/static/images/xxx.png"（相對路徑，不帶網域）
@@ -87,27 +127,65 @@ def upload_to_cloudinary(image_path, public_id=None):
 def upload_to_local_storage(image_path, public_id=None):
     return _upload_to_local(image_path, public_id, "slice")
 
+# ========= 內容定址切片 =========
+def upload_slice_bytes(buf: bytes) -> str:
+    """
+    以內容雜湊當 public_id 上傳切片：相同內容只會上傳一次。
+      - 程序內：digest → URL 的 LRU 快取，命中時完全不發網路請求
+      - 跨程序／請求：overwrite=False，Cloudinary 直接回傳既有資源
+    """
+    digest = slice_digest(buf)
+    url = cached_slice_url(digest)
+    if url:
+        return url
+
+    url = _upload_to_cloudinary(io.BytesIO(buf), f"slice_{digest}", "slice", overwrite=False)
+    remember_slice_url(digest, url)
+    return url
+
+def slice_digest(buf: bytes) -> str:
+    """切片內容雜湊（blake2b-96, hex），同時用於 public_id 與快取鍵"""
+    return hashlib.blake2b(buf, digest_size=12).hexdigest()
+
+def cached_slice_url(digest: str) -> Optional[str]:
+    """查 digest → URL 快取，沒有時回傳 None"""
+    with _SLICE_URL_LOCK:
+        url = _SLICE_URL_CACHE.get(digest)
+        if url:
+            _SLICE_URL_CACHE.move_to_end(digest)
+        return url
+
+def remember_slice_url(digest: str, url: str) -> None:
+    """記下已上傳切片的 URL（超過上限時丟掉最久未用的）"""
+    with _SLICE_URL_LOCK:
+        _SLICE_URL_CACHE[digest] = url
+        while len(_SLICE_URL_CACHE) > _SLICE_URL_CACHE_MAX:
+            _SLICE_URL_CACHE.popitem(last=False)
+
 # ========= 內部實作 =========
-def _upload_to_cloudinary(image_path: str, public_id: Optional[str], public_id_prefix: str) -> str:
+def _upload_to_cloudinary(
+    image_path: Union[str, BinaryIO], public_id: Optional[str], public_id_prefix: str, overwrite: bool = True
+) -> str:
     if not _cloudinary_config():
         raise RuntimeError("Cloudinary not configured/imported")
 
     # 目錄（夾）名稱
-    folder = os.getenv("CLOUDINARY_FOLDER", "imagemapper").strip() or None
+    folder = cloudinary_folder()
 
     # 決定 public_id
     if not public_id:
-        public_id = f"{public_id_prefix}_{uuid.uuid4().hex}"
+        public_id = f"{public_id_prefix}_{os.urandom(16).hex()}"
 
-    # 上傳
+    # 上傳（全程序共用的並行上限，避免多請求同時爆量觸發限流）
     try:
-        resp = cu.upload(
-            image_path,
-            folder=folder,
-            public_id=public_id,
-            overwrite=True,
-            resource_type="image",
-        )
+        with CLOUDINARY_SLOTS:
+            resp = cu.upload(
+                image_path,
+                folder=folder,
+                public_id=public_id,
+                overwrite=overwrite,
+                resource_type="image",
+            )
         url = resp.get("secure_url") or resp.get("url")
         if not url:
             raise RuntimeError(f"Cloudinary response has no URL: {resp}")
@@ -118,22 +196,31 @@ def _upload_to_cloudinary(image_path: str, public_id: Optional[str], public_id_p
     except Exception as e:
         raise RuntimeError(f"Cloudinary upload exception: {e}") from e
 
+def cloudinary_folder() -> Optional[str]:
+    """上傳目標資料夾（CLOUDINARY_FOLDER，預設 imagemapper；空字串表示根目錄）"""
+    return os.getenv("CLOUDINARY_FOLDER", "imagemapper").strip() or None
+
 def _upload_to_local(image_path: str, public_id: Optional[str], public_id_prefix: str) -> str:
     # 準備檔名
     ext = Path(image_path).suffix or ".png"
     if public_id:
         filename = f"{public_id}{ext}"
     else:
-        filename = f"{public_id_prefix}_{uuid.uuid4().hex}{ext}"
+        filename = f"{public_id_prefix}_{os.urandom(16).hex()}{ext}"
 
     dest = LOCAL_STATIC_DIR / filename
-    dest.parent.mkdir(parents=True, exist_ok=True)
+    # LOCAL_STATIC_DIR 已在 import 時建立；只有 public_id 含子目錄時才需要 mkdir（每個目錄一次）
+    if dest.parent not in _CREATED_DIRS:
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        _CREATED_DIRS.add(dest.parent)
 
-    # 優先 move（更快）；失敗再 copy2
+    # 同一檔案系統直接 rename；跨裝置時 copyfile（Linux 走 sendfile/copy_file_range 零拷貝，
+    # 不做 copy2 的權限/時間戳 metadata 複製）再刪除原檔
     try:
-        shutil.move(image_path, dest)
-    except Exception:
-        shutil.copy2(image_path, dest)
+        os.rename(image_path, dest)
+    except OSError:
+        shutil.copyfile(image_path, dest)
+        os.unlink(image_path)
 
     # 回傳相對路徑，避免在雲端環境硬編 localhost
     rel_url = f"/static/images/{dest.name}"
@@ -0,0 +1,105 @@
+# utils/uploader_async.py
+import asyncio
+import logging
+from typing import List, Sequence, Union
+
+from utils.uploader import (
+    CLOUDINARY_MAX_INFLIGHT,
+    CLOUDINARY_SLOTS,
+    cached_slice_url,
+    cloudinary_folder,
+    init_cloudinary,
+    remember_slice_url,
+    slice_digest,
+)
+
+# httpx 為選用套件；未安裝時 ASYNC_UPLOAD_AVAILABLE=False，呼叫端改走 SDK 同步路徑
+try:
+    import httpx
+    import cloudinary
+    import cloudinary.utils as cutils
+    _HTTPX_IMPORTED = True
+except Exception:
+    # 不在 import 時記 log：會在 app 設定 logging 之前觸發 root logger 的預設設定
+    _HTTPX_IMPORTED = False
+
+# HTTP/2 需要 h2；沒有時退回 HTTP/1.1 連線池（仍可並行）
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except Exception:
+    _HTTP2 = False
+
+ASYNC_UPLOAD_AVAILABLE = _HTTPX_IMPORTED
+
+# 等待跨請求上傳名額時的輪詢間隔（秒）
+_SLOT_POLL_INTERVAL = 0.02
+
+# ========= 對外主入口 =========
+async def upload_slices_async(blobs: Sequence[bytes]) -> List[Union[str, BaseException]]:
+    """
+    以 Cloudinary REST 上傳 API 並行上傳多個切片（內容雜湊 public_id，與 upload_slice_bytes 相同規則）。
+    全部請求共用一個 httpx.AsyncClient：有 h2 時在同一條 HTTP/2 連線上多工，省去每張的 TCP/TLS 握手。
+    同時進行中的 POST 受兩層限制：本次呼叫最多 CLOUDINARY_MAX_INFLIGHT 個，
+    且與 SDK 路徑共用程序層級的 CLOUDINARY_SLOTS（跨請求上限）。
+    回傳與 blobs 同順序的清單；失敗的位置放例外物件（不中斷其他上傳），由呼叫端決定如何回報。
+    """
+    if not (_HTTPX_IMPORTED and init_cloudinary()):
+        raise RuntimeError("Cloudinary not configured/imported (or httpx missing)")
+
+    api_url = cutils.cloudinary_api_url("upload", resource_type="image")
+    limits = httpx.Limits(max_connections=CLOUDINARY_MAX_INFLIGHT)
+    # HTTP/2 時所有切片都是同一條連線上的 stream，max_connections 管不到，要自己限流
+    inflight = asyncio.Semaphore(CLOUDINARY_MAX_INFLIGHT)
+    async with httpx.AsyncClient(http2=_HTTP2, limits=limits, timeout=60) as client:
+        return list(await asyncio.gather(
+            *(_upload_one(client, api_url, buf, inflight) for buf in blobs),
+            return_exceptions=True,
+        ))
+
+def upload_slices(blobs: Sequence[bytes]) -> List[Union[str, BaseException]]:
+    """upload_slices_async 的同步包裝（給 Flask view 等同步程式碼使用）"""
+    return asyncio.run(upload_slices_async(blobs))
+
+# ========= 內部實作 =========
+async def _upload_one(
+    client: "httpx.AsyncClient", api_url: str, buf: bytes, inflight: asyncio.Semaphore
+) -> str:
+    digest = slice_digest(buf)
+    url = cached_slice_url(digest)
+    if url:
+        return url
+
+    async with inflight:
+        # 與 SDK 相同的簽章方式（timestamp + 參數，api_secret 簽名）；
+        # 拿到名額後才簽，避免排隊太久 timestamp 過期
+        await _acquire_slot()
+        try:
+            params = cutils.sign_request({
+                "timestamp": cutils.now(),
+                "public_id": f"slice_{digest}",
+                "folder": cloudinary_folder(),
+                "overwrite": "false",
+            }, {})
+            resp = await client.post(api_url, data=params, files={"file": (f"slice_{digest}", buf)})
+        finally:
+            CLOUDINARY_SLOTS.release()
+    try:
+        body = resp.json()
+    except ValueError:
+        body = {}
+    if resp.status_code >= 400:
+        message = (body.get("error") or {}).get("message") or resp.text
+        raise RuntimeError(f"Cloudinary upload failed ({resp.status_code}): {message}")
+
+    url = body.get("secure_url") or body.get("url")
+    if not url:
+        raise RuntimeError(f"Cloudinary response has no URL: {body}")
+    logging.info(f"Uploaded to Cloudinary: {url}")
+    remember_slice_url(digest, url)
+    return url
+
+async def _acquire_slot() -> None:
+    """取得跨請求共用的上傳名額（threading 號誌不能在 event loop 上阻塞等待，改為輪詢）"""
+    while not CLOUDINARY_SLOTS.acquire(blocking=False):
+        await asyncio.sleep(_SLOT_POLL_INTERVAL)